@@ -9,6 +9,8 @@ Features
 - Resolves missing IDs by scraping the shelter page (cached locally)
 - Region filtering via bounding-box presets (Sjælland, Fyn, Jylland, Bornholm, Lolland-Falster, Møn, Amager)
 - Probe mode (quick BookingDates sanity), quiet mode, max-places limiter
+- Parallel ID resolution and availability checks over a pooled session, with a global rate limit
+- Recent availability results reused from a short-TTL SQLite cache (--probe-ttl)
 - CSV output (lat,lng,region,name,url,place_id) ready for maps
 
 Usage
@@ -19,24 +21,53 @@ See `python find_available_shelters.py --help` for examples and all options.
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import contextlib
 import csv
+import functools
+import io
 import json
 import os
 import re
+import sqlite3
+import threading
 import time
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Set, Tuple
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:  # optional: stream-parse BookingDates instead of materializing the whole JSON body
+    import ijson
+except ImportError:
+    ijson = None
+
+try:  # optional: much faster JSON decoding for the (float-heavy) list API
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # optional: persistent HTTP cache for shelter detail pages (--http-cache)
+    import requests_cache
+except ImportError:
+    requests_cache = None
 
 
 # ---------- Constants ----------
 BASE = "https://book.naturstyrelsen.dk"
 API_PLACES = f"{BASE}/includes/branding_files/shelterbooking/includes/inc_ajaxbookingplaces.asp"
 API_BOOKINGS = f"{BASE}/includes/branding_files/shelterbooking/includes/inc_ajaxgetbookingsforsingleplace.asp"
+STED_PREFIX = f"{BASE}/sted/"  # shelter detail pages
+HTTP_CACHE_FILE = "shelter_http_cache.sqlite"
+PROBE_CACHE_FILE = "probe_cache.sqlite"
+
+# Extra headers for the ASP ajax endpoints
+AJAX_HEADERS: Dict[str, str] = {"X-Requested-With": "XMLHttpRequest", "Referer": f"{BASE}/soeg/?s1=3012"}
 
 # Type/category ids (NOT real place ids)
-TYPE_IDS: Set[int] = {3012, 3031, 3091}
+TYPE_IDS: FrozenSet[int] = frozenset({3012, 3031, 3091})
 
 # Region presets (lat_min, lat_max, lon_min, lon_max)
 REGION_PRESETS: Dict[str, Tuple[float, float, float, float]] = {
@@ -62,9 +93,34 @@ REGION_ALIASES: Dict[str, str] = {
 
 
 # ---------- HTTP helpers ----------
-def make_session() -> requests.Session:
-    """Return a session with polite, browser-like headers and a warm cookie jar."""
-    s = requests.Session()
+def make_session(http_cache: bool = False) -> requests.Session:
+    """
+    Return a pooled, retrying session with browser-like headers and a warm cookie jar.
+    With `http_cache`, shelter detail pages are cached on disk (requires requests-cache).
+    """
+    if http_cache and requests_cache is None:
+        print("Warning: --http-cache needs the requests-cache package; continuing without it.")
+    if http_cache and requests_cache is not None:
+        s = requests_cache.CachedSession(
+            HTTP_CACHE_FILE,
+            expire_after=timedelta(days=30),
+            allowable_methods=("GET",),
+            stale_if_error=True,
+            # Only /sted/ pages are cached; list, bookings and cookie warm-up stay live
+            urls_expire_after={STED_PREFIX: timedelta(days=30), "*": requests_cache.DO_NOT_CACHE},
+        )
+    else:
+        s = requests.Session()
+    # Keep-alive pool large enough for the worker threads; back off on throttling/5xx (GET only)
+    retry = Retry(
+        total=4,
+        backoff_factor=0.4,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET"]),
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
     s.headers.update({
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
         "Accept": "application/json, text/javascript, */*; q=0.1",
@@ -82,9 +138,16 @@ def make_session() -> requests.Session:
 
 def get_json(session: requests.Session, url: str, params: Dict[str, Any]) -> Any:
     """GET JSON from ASP endpoints (some return JSON with text/html content-type)."""
-    headers = {"X-Requested-With": "XMLHttpRequest", "Referer": f"{BASE}/soeg/?s1=3012"}
-    r = session.get(url, params=params, headers=headers, timeout=30)
+    r = session.get(url, params=params, headers=AJAX_HEADERS, timeout=30)
     r.raise_for_status()
+    if orjson is not None:
+        body = r.content.strip()
+        if body.startswith(b"\xef\xbb\xbf"):  # orjson rejects a UTF-8 BOM
+            body = body[3:]
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            pass  # e.g. a Latin-1/cp1252 body: orjson only takes UTF-8, decode via r.text below
     try:
         return r.json()
     except Exception:
@@ -94,32 +157,76 @@ def get_json(session: requests.Session, url: str, params: Dict[str, Any]) -> Any
         raise
 
 
-def http_get_page(session: requests.Session, url: str) -> str:
-    """Fetch a page, ensuring /sted/ paths have trailing slash to avoid 404."""
-    if url.startswith(f"{BASE}/sted/") and not url.endswith("/"):
-        url = url + "/"
-    r = session.get(url, timeout=15, allow_redirects=True)
+def http_get_page(
+    session: requests.Session,
+    url: str,
+    validators: Optional[Dict[str, Any]] = None,
+) -> requests.Response:
+    """
+    Fetch a page, ensuring /sted/ paths have trailing slash to avoid 404.
+    With `validators` (a cache entry's etag/last_modified) the GET is conditional;
+    an unchanged page comes back as a 304 with no body for the caller to check.
+    """
+    if url.startswith(STED_PREFIX) and url[-1] != "/":
+        url += "/"
+    headers: Dict[str, str] = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    r = session.get(url, headers=headers, timeout=15, allow_redirects=True)
     if r.status_code == 404 and not url.endswith("/"):
-        r = session.get(url + "/", timeout=15, allow_redirects=True)
+        r = session.get(url + "/", headers=headers, timeout=15, allow_redirects=True)
+    if r.status_code == 304:
+        return r
     r.raise_for_status()
-    return r.text
+    return r
+
+
+class RateLimiter:
+    """Thread-safe pacing: hands out request slots at most `qps` per second overall."""
+
+    def __init__(self, qps: float) -> None:
+        self.interval = 1.0 / qps if qps > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            slot = max(self._next, time.monotonic())
+            self._next = slot + self.interval
+        # sleep outside the lock so other workers can reserve their own slots
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
 
 
 # ---------- Region helpers ----------
+_NORMALIZE_TABLE = str.maketrans({"æ": "ae", "ø": "oe", "å": "aa", " ": None, "_": None, "-": None})
+
+
 def _normalize_ascii(s: str) -> str:
-    s = s.strip().lower()
-    s = s.replace("æ", "ae").replace("ø", "oe").replace("å", "aa")
-    return s.replace(" ", "").replace("_", "").replace("-", "")
+    return s.strip().lower().translate(_NORMALIZE_TABLE)
+
+
+# Exact-match lookup: canonical keys, their ASCII forms and all aliases -> canonical key
+_REGION_LOOKUP: Dict[str, str] = {
+    **{_normalize_ascii(k): k for k in REGION_PRESETS},
+    **REGION_ALIASES,
+    **{k: k for k in REGION_PRESETS},
+}
 
 
 def resolve_region_name(user_input: str) -> Optional[str]:
     """Map user input to a canonical region key using presets and aliases."""
     raw = user_input.strip().lower()
-    if raw in REGION_PRESETS:
-        return raw
-    norm = _normalize_ascii(raw)
-    if norm in REGION_ALIASES:
-        return REGION_ALIASES[norm]
+    norm = raw.translate(_NORMALIZE_TABLE)
+    key = _REGION_LOOKUP.get(raw) or _REGION_LOOKUP.get(norm)
+    if key:
+        return key
     # loose contains matching on canonical keys & aliases
     for key in REGION_PRESETS.keys():
         if raw in key or key in raw:
@@ -130,65 +237,196 @@ def resolve_region_name(user_input: str) -> Optional[str]:
     return None
 
 
+def match_region(
+    place: Dict[str, Any],
+    boxes: List[Tuple[str, Tuple[float, float, float, float]]],
+) -> Optional[str]:
+    """Return the first region key whose bbox contains the place, or None."""
+    lat, lng = place["lat"], place["lng"]
+    if lat is None or lng is None:
+        return None
+    for key, (lat_min, lat_max, lon_min, lon_max) in boxes:
+        if lat_min <= lat <= lat_max and lon_min <= lng <= lon_max:
+            return key
+    return None
+
+
 # ---------- ID extraction ----------
-ID_REGEXES = [
-    re.compile(r"inc_ajaxgetbookingsforsingleplace\.asp\?i=(\d+)", re.I),
-    re.compile(r'data-place-id\s*=\s*"(\d+)"', re.I),
-    re.compile(r'place[_\s-]*id\s*[:=]\s*"?(\d+)"?', re.I),
-    re.compile(r'[?&]i=(\d+)', re.I),
-]
+# Authoritative marker: the bookings endpoint URL embedded in every shelter page
+ID_ANCHOR = b"inc_ajaxgetbookingsforsingleplace.asp?i="
+ID_ANCHOR_DIGITS = re.compile(rb"\d+")
+
+# List-row fields known to carry the booking PlaceID, tried in order before scraping
+ROW_ID_FIELDS: Tuple[str, ...] = ("PlaceID", "PlaceId")
+# Other per-row ids, not (yet) confirmed to be booking ids; --probe prints them next to the
+# resolved id so they can be checked before being promoted into ROW_ID_FIELDS
+ROW_ID_CANDIDATES: Tuple[str, ...] = ("LocationID", "ObjectID", "ID")
+
+# Fallback markers in priority order; one alternation, one capture group per marker
+ID_REGEX = re.compile(
+    rb"inc_ajaxgetbookingsforsingleplace\.asp\?i=(\d+)"
+    rb'|data-place-id\s*=\s*"(\d+)"'
+    rb'|place[_\s-]*id\s*[:=]\s*"?(\d+)'
+    rb"|[?&]i=(\d+)",
+    re.I,
+)
 
 
 def extract_place_id_from_row(row: Dict[str, Any]) -> Optional[int]:
-    """Only accept the real per-shelter PlaceID (ignore type/category ids)."""
-    pid = row.get("PlaceID")
-    try:
-        if pid is None:
-            return None
-        pid = int(pid)
-        return None if pid in TYPE_IDS else pid
-    except Exception:
-        return None
+    """Only accept a real per-shelter PlaceID from the row (ignore type/category ids)."""
+    for key in ROW_ID_FIELDS:
+        try:
+            pid = int(row[key])
+        except Exception:
+            continue
+        if pid not in TYPE_IDS:
+            return pid
+    return None
 
 
-def extract_place_id_from_html(html: str) -> Optional[int]:
-    for rgx in ID_REGEXES:
-        m = rgx.search(html)
+def extract_place_id_from_html(html: bytes) -> Optional[int]:
+    # Fast path: C-level substring search for the anchor, then only look at the bytes after it
+    i = html.find(ID_ANCHOR)
+    if i >= 0:
+        start = i + len(ID_ANCHOR)
+        m = ID_ANCHOR_DIGITS.match(html, start, start + 20)
         if m:
+            return int(m.group(0))
+    # Slow path: a single regex pass; keep the match of the highest-priority marker
+    best = None
+    for m in ID_REGEX.finditer(html):
+        if best is None or m.lastindex < best.lastindex:
+            best = m
+            if best.lastindex == 1:
+                break
+    return int(best.group(best.lastindex)) if best else None
+
+
+# ---------- Cache helpers ----------
+# The ID cache is line-delimited JSON, one object per line:
+#   {"u": url, "i": place_id, "e": etag, "m": last_modified}  ("e"/"m" only when the page sent them)
+# New ids are appended; later lines win; compact_cache() drops superseded lines.
+# In memory each url maps to {"id": place_id, "etag": ..., "last_modified": ...}.
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _json_line(obj: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj) + b"\n"
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _read_cache_lines(path: str) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Return ({url: entry}, number of non-empty lines) from an NDJSON cache file."""
+    cache: Dict[str, Dict[str, Any]] = {}
+    lines = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            lines += 1
             try:
-                return int(m.group(1))
+                obj = _json_loads(line)
+                v = obj["i"]
+                if isinstance(v, (int, str)) and str(v).isdigit():
+                    cache[obj["u"]] = {"id": int(v), "etag": obj.get("e"), "last_modified": obj.get("m")}
             except Exception:
-                pass
-    return None
+                continue  # torn/garbled line (e.g. interrupted append)
+    return cache, lines
 
 
-# ---------- Cache helpers ----------
-def load_cache(path: str) -> Dict[str, int]:
-    """Load {url: place_id} cache from disk."""
-    if not path or not os.path.exists(path):
+def _read_legacy_cache(path: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Parse an old single-object {url: place_id} JSON cache; None if `path` is not one."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.lstrip().startswith(b"{"):
+        return None
+    try:
+        obj = json.loads(data)  # an NDJSON file with 2+ lines fails here ("Extra data")
+    except ValueError:
+        return None
+    if not isinstance(obj, dict) or "u" in obj:
+        return None
+    return {
+        url: {"id": int(v), "etag": None, "last_modified": None}
+        for url, v in obj.items()
+        if isinstance(v, (int, str)) and str(v).isdigit()
+    }
+
+
+def _write_cache(path: str, cache: Dict[str, Dict[str, Any]]) -> None:
+    """Atomically write the whole cache as NDJSON."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for url, entry in cache.items():
+            append_cache_entry(f, url, entry)
+    os.replace(tmp, path)
+
+
+def load_cache(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Load {url: {"id", "etag", "last_modified"}} cache from disk.
+    Old JSON caches are converted to NDJSON: in place if `path` is one, or from
+    the sibling .json file (e.g. ids_cache.json) when `path` does not exist yet.
+    """
+    if not path:
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return {k: int(v) for k, v in data.items() if isinstance(v, (int, str)) and str(v).isdigit()}
+        src = path
+        if not os.path.exists(path):
+            src = os.path.splitext(path)[0] + ".json"
+            if src == path or not os.path.exists(src):
+                return {}
+        legacy = _read_legacy_cache(src)
+        if legacy is not None:
+            _write_cache(path, legacy)
+            print(f"Converted {len(legacy)} cached IDs from {src} to NDJSON ({path}).")
+            return legacy
+        return _read_cache_lines(path)[0] if src == path else {}
     except Exception:
         return {}
 
 
-def save_cache(path: str, cache: Dict[str, int]) -> None:
-    """Atomically save cache to disk."""
-    if not path:
-        return
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
+def cached_place_id(cache: Dict[str, Dict[str, Any]], url: str) -> Optional[int]:
+    entry = cache.get(url)
+    return entry["id"] if entry else None
+
+
+def open_cache_for_append(path: str) -> Any:
+    """Open the cache for appending, terminating a torn last line first."""
+    f = open(path, "ab")
+    if f.tell() > 0:
+        with open(path, "rb") as r:
+            r.seek(-1, os.SEEK_END)
+            if r.read(1) != b"\n":
+                f.write(b"\n")
+    return f
+
+
+def append_cache_entry(f: Any, url: str, entry: Dict[str, Any]) -> None:
+    """Append one resolved entry to an open (binary, append-mode) cache file."""
+    obj: Dict[str, Any] = {"u": url, "i": entry["id"]}
+    if entry.get("etag"):
+        obj["e"] = entry["etag"]
+    if entry.get("last_modified"):
+        obj["m"] = entry["last_modified"]
+    f.write(_json_line(obj))
+
+
+def compact_cache(path: str) -> bool:
+    """Atomically rewrite the cache without superseded lines once they outnumber live ones."""
+    if not path or not os.path.exists(path):
+        return False
+    cache, lines = _read_cache_lines(path)
+    if not cache or lines <= 2 * len(cache):
+        return False  # nothing parsed: never overwrite a file we could not read
+    _write_cache(path, cache)
+    return True
 
 
 # ---------- API wrappers ----------
-def fetch_all_places(session: requests.Session, page_size: int = 200, max_pages: int = 500) -> List[Dict[str, Any]]:
-    """Pull all shelters from the list API (t=1)."""
-    places: List[Dict[str, Any]] = []
+def iter_places(session: requests.Session, page_size: int = 200, max_pages: int = 500) -> Iterator[Dict[str, Any]]:
+    """Yield shelters from the list API (t=1), fetching pages only as the caller consumes them."""
     for p in range(1, max_pages + 1):
         data = get_json(session, API_PLACES, {"pid": 0, "p": p, "r": 50000, "ps": page_size, "t": 1})
         rows = data.get("BookingPlacesList", [])
@@ -207,70 +445,283 @@ def fetch_all_places(session: requests.Session, page_size: int = 200, max_pages:
             except Exception:
                 lat_f = lng_f = None
             region = c.get("RegionName") or ""
-            places.append({
+            yield {
                 "title": c.get("Title") or uri.replace("-", " ").title(),
-                "url": f"{BASE}/sted/{uri}/",
+                "url": f"{STED_PREFIX}{uri}/",
                 "place_id": pid,
                 "lat": lat_f,
                 "lng": lng_f,
                 "region": region,
-            })
+                "row_ids": {k: c[k] for k in ROW_ID_CANDIDATES if c.get(k) not in (None, "")},
+            }
         if len(rows) < page_size:
             break
         time.sleep(0.15)  # be polite
-    return places
 
 
 def ensure_place_ids(
     session: requests.Session,
     places: List[Dict[str, Any]],
-    cache: Dict[str, int],
+    cache: Dict[str, Dict[str, Any]],
     refresh_cache: bool = False,
+    workers: int = 8,
+    limiter: Optional[RateLimiter] = None,
+    cache_path: str = "",
 ) -> int:
     """
     For places missing a valid place_id (or where id matches a known type id),
     use cache if present; otherwise fetch detail HTML and extract the id; update cache.
+    With `refresh_cache`, cached pages are re-fetched conditionally (ETag/Last-Modified)
+    and a 304 keeps the cached id without re-parsing; an --http-cache session is
+    bypassed for that pass so the revalidation actually reaches the server.
     Resolves ONLY for provided `places` subset (already limited by caller).
+    Page fetches run concurrently on `workers` threads, paced by `limiter`.
+    Newly resolved ids are appended to `cache_path` as they are found.
     """
-    targets = [p for p in places if (p.get("place_id") is None) or (p.get("place_id") in TYPE_IDS)]
-    fixed = 0
-    for idx, p in enumerate(targets, 1):
+    type_ids = TYPE_IDS
+    targets = [p for p in places if (p.get("place_id") is None) or (p.get("place_id") in type_ids)]
+    cache_f = open_cache_for_append(cache_path) if cache_path else None
+    cache_lock = threading.Lock()
+
+    def resolve_one(p: Dict[str, Any]) -> bool:
         url = p["url"]
+        entry = cache.get(url)
+        if entry and entry["id"] in type_ids:
+            entry = None
         # 1) cache hit?
-        if not refresh_cache and url in cache and cache[url] not in TYPE_IDS:
-            p["place_id"] = cache[url]
-            fixed += 1
-        else:
-            # 2) scrape page
-            try:
-                html = http_get_page(session, url)
-                pid = extract_place_id_from_html(html)
-                if pid and pid not in TYPE_IDS:
-                    p["place_id"] = pid
-                    cache[url] = pid
-                    fixed += 1
-            except Exception:
-                pass
-        if idx % 20 == 0:
-            print(f"  …resolved {fixed}/{idx} (of {len(targets)})")
-        time.sleep(0.05)  # gentle pacing
+        if not refresh_cache and entry:
+            p["place_id"] = entry["id"]
+            return True
+        # 2) scrape page (conditional if we have validators from a previous resolve)
+        if limiter is not None:
+            limiter.wait()  # gentle pacing
+        try:
+            r = http_get_page(session, url, entry)
+            if r.status_code == 304 and entry:
+                p["place_id"] = entry["id"]  # page unchanged since we resolved it
+                return True
+            pid = extract_place_id_from_html(r.content)  # bytes: skip charset detection/decoding
+            if pid and pid not in type_ids:
+                p["place_id"] = pid
+                new_entry = {"id": pid, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                with cache_lock:
+                    cache[url] = new_entry
+                    if cache_f is not None and new_entry != entry:  # unchanged -> no duplicate line
+                        append_cache_entry(cache_f, url, new_entry)
+                return True
+        except Exception:
+            pass
+        return False
+
+    # A requests-cache session would answer the conditional GET from disk with a 200
+    bypass = refresh_cache and hasattr(session, "cache_disabled")
+    fixed = 0
+    try:
+        with session.cache_disabled() if bypass else contextlib.nullcontext(), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            for idx, ok in enumerate(ex.map(resolve_one, targets), 1):
+                fixed += ok
+                if idx % 20 == 0:
+                    print(f"  …resolved {fixed}/{idx} (of {len(targets)})")
+    finally:
+        if cache_f is not None:
+            cache_f.close()
     return fixed
 
 
-def fetch_booked_dates(session: requests.Session, place_id: int, on_date: datetime) -> Set[str]:
-    """Return a set of 'YYYY-MM-DD' strings that are booked for this place."""
-    data = get_json(session, API_BOOKINGS, {"i": place_id, "d": on_date.strftime("%Y%m%d")})
-    return {str(x) for x in data.get("BookingDates", []) if x}
+@functools.lru_cache(maxsize=64)
+def _api_date(on_date: datetime) -> str:
+    """'YYYYMMDD' query value for the bookings endpoint (memoized: every worker asks for the same few dates)."""
+    return on_date.strftime("%Y%m%d")
+
+
+def fetch_booked_dates_stream(session: requests.Session, place_id: int, on_date: datetime) -> FrozenSet[str]:
+    """Like fetch_booked_dates, but feeds the raw byte stream to ijson (no intermediate dict)."""
+    params = {"i": place_id, "d": _api_date(on_date)}
+    with session.get(API_BOOKINGS, params=params, headers=AJAX_HEADERS, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True  # let urllib3 undo gzip/deflate
+        r.raw.auto_close = False  # keep raw "open" at EOF so the BufferedReader can finish
+        stream = io.BufferedReader(r.raw)
+        if stream.peek(3)[:3] == b"\xef\xbb\xbf":  # yajl rejects a UTF-8 BOM
+            stream.read(3)
+        return frozenset(str(x) for x in ijson.items(stream, "BookingDates.item") if x)
+
+
+# In-process cache of BookingDates responses; the endpoint answers per month
+_bookings_cache: Dict[Tuple[int, int, int], FrozenSet[str]] = {}
+
+
+def fetch_booked_dates(
+    session: requests.Session,
+    place_id: int,
+    on_date: datetime,
+    limiter: Optional[RateLimiter] = None,
+) -> FrozenSet[str]:
+    """
+    Return a frozenset of 'YYYY-MM-DD' strings booked for this place in on_date's month.
+    `limiter` is waited on only when a request is actually sent (not on a cache hit).
+    """
+    key = (place_id, on_date.year, on_date.month)
+    booked = _bookings_cache.get(key)
+    if booked is not None:
+        return booked
+    if limiter is not None:
+        limiter.wait()  # be polite
+    booked = None
+    if ijson is not None:
+        try:
+            booked = fetch_booked_dates_stream(session, place_id, on_date)
+        except ijson.JSONError:
+            # e.g. a Latin-1/cp1252 body: yajl only takes UTF-8, re-fetch via get_json below
+            if limiter is not None:
+                limiter.wait()
+    if booked is None:
+        data = get_json(session, API_BOOKINGS, {"i": place_id, "d": _api_date(on_date)})
+        booked = frozenset(str(x) for x in data.get("BookingDates", []) if x)
+    _bookings_cache[key] = booked
+    return booked
+
+
+def fetch_booked_window(
+    session: requests.Session,
+    place_id: int,
+    start_date: datetime,
+    nights: int,
+    limiter: Optional[RateLimiter] = None,
+) -> FrozenSet[str]:
+    """Booked dates for every month touched by the nights [start_date, start_date+n)."""
+    booked = fetch_booked_dates(session, place_id, start_date, limiter)
+    last = date.fromordinal(start_date.toordinal() + nights - 1)
+    y, m = start_date.year, start_date.month
+    while (y, m) != (last.year, last.month):
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+        booked |= fetch_booked_dates(session, place_id, datetime(y, m, 1), limiter)
+    return booked
+
+
+# Windows up to this many nights are tested as int bitmasks (bit n = start_date + n days)
+MAX_BITMASK_NIGHTS = 63
+
+
+def booked_bits(booked: FrozenSet[str], start_ord: int) -> int:
+    """Encode booked 'YYYY-MM-DD' dates within MAX_BITMASK_NIGHTS days of start_ord as a bitmask."""
+    bits = 0
+    for d in booked:
+        try:
+            n = date.fromisoformat(d).toordinal() - start_ord
+        except ValueError:
+            continue
+        if 0 <= n < MAX_BITMASK_NIGHTS:
+            bits |= 1 << n
+    return bits
+
+
+class ProbeCache:
+    """
+    Short-lived SQLite cache of booked-night bitmasks keyed by (place_id, start date),
+    so repeat runs (e.g. trying --filter variations) skip recent availability requests.
+    `span` is how many days from the start date the stored bits are known for.
+    Runs in autocommit/WAL mode so concurrent runs can share the file; a cache
+    failure after opening only costs a live fetch (get -> None, put -> no-op).
+    """
 
+    def __init__(self, path: str, ttl: float) -> None:
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bookings ("
+            "pid INTEGER, date TEXT, bits INTEGER, span INTEGER, ts INTEGER, PRIMARY KEY (pid, date))"
+        )
+        self._conn.execute("DELETE FROM bookings WHERE ts < ?", (int(time.time() - ttl),))
+
+    def get(self, place_id: int, day: str, nights: int) -> Optional[int]:
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT bits, span, ts FROM bookings WHERE pid = ? AND date = ?", (place_id, day)
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        bits, span, ts = row
+        if span < nights or time.time() - ts >= self.ttl:
+            return None
+        return bits
 
-def is_available(session: requests.Session, place_id: int, start_date: datetime, nights: int, quiet: bool = False) -> bool:
-    """Return True if none of the nights [start_date, start_date+n) are booked."""
-    needed = [(start_date + timedelta(days=i)).date().isoformat() for i in range(nights)]
-    booked = fetch_booked_dates(session, place_id, start_date)
-    hits = [d for d in needed if d in booked]
+    def put(self, place_id: int, day: str, bits: int, span: int) -> None:
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO bookings (pid, date, bits, span, ts) VALUES (?, ?, ?, ?, ?)",
+                    (place_id, day, bits, span, int(time.time())),
+                )
+        except sqlite3.Error:
+            pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def get_or_fetch_booked_bits(
+    session: requests.Session,
+    place_id: int,
+    start_date: datetime,
+    nights: int,
+    probe_cache: Optional[ProbeCache] = None,
+    limiter: Optional[RateLimiter] = None,
+) -> int:
+    """Booked-night bitmask for the window (see booked_bits), from `probe_cache` when fresh."""
+    day = start_date.date().isoformat()
+    if probe_cache is not None:
+        bits = probe_cache.get(place_id, day, nights)
+        if bits is not None:
+            return bits
+    start_ord = start_date.toordinal()
+    bits = booked_bits(fetch_booked_window(session, place_id, start_date, nights, limiter), start_ord)
+    if probe_cache is not None:
+        # Fetched months cover the window up to the end of its last month
+        last = date.fromordinal(start_ord + nights - 1)
+        y, m = (last.year + 1, 1) if last.month == 12 else (last.year, last.month + 1)
+        span = min(date(y, m, 1).toordinal() - start_ord, MAX_BITMASK_NIGHTS)
+        probe_cache.put(place_id, day, bits, span)
+    return bits
+
+
+def is_available(
+    session: requests.Session,
+    place_id: int,
+    start_date: datetime,
+    nights: int,
+    quiet: bool = False,
+    probe_cache: Optional[ProbeCache] = None,
+    limiter: Optional[RateLimiter] = None,
+    log: Optional[List[str]] = None,
+) -> bool:
+    """
+    Return True if none of the nights [start_date, start_date+n) are booked.
+    Unless `quiet`, the per-place detail line is appended to `log` (printed if None).
+    """
+    start_ord = start_date.toordinal()
+    emit = log.append if log is not None else print
+    if nights > MAX_BITMASK_NIGHTS:
+        booked = fetch_booked_window(session, place_id, start_date, nights, limiter)
+        needed = frozenset(date.fromordinal(start_ord + i).isoformat() for i in range(nights))
+        if not quiet:
+            hits = sorted(needed & booked)
+            emit(f"  place_id={place_id} needs={sorted(needed)} booked_hits={hits} booked_count={len(booked)}")
+        return booked.isdisjoint(needed)
+    bits = get_or_fetch_booked_bits(session, place_id, start_date, nights, probe_cache, limiter)
+    hit_bits = bits & ((1 << nights) - 1)
     if not quiet:
-        print(f"  place_id={place_id} needs={needed} booked_hits={hits} booked_count={len(booked)}")
-    return len(hits) == 0
+        needed_list = [date.fromordinal(start_ord + i).isoformat() for i in range(nights)]
+        hits = [d for i, d in enumerate(needed_list) if hit_bits >> i & 1]
+        emit(f"  place_id={place_id} needs={needed_list} booked_hits={hits} booked_nearby={bin(bits).count('1')}")
+    return hit_bits == 0
 
 
 # ---------- CLI & main ----------
@@ -299,17 +750,25 @@ Examples:
   Probe the first 5 shelters (quick BookingDates debug):
     python find_available_shelters.py --start 2025-09-07 --nights 1 --probe 5
 
+  Check with fewer parallel workers and a lower request rate:
+    python find_available_shelters.py --start 2025-09-07 --nights 1 --workers 4 --qps 4
+
 Cache options:
-  --cache-file FILE   Path to persistent ID cache (default: ids_cache.json)
-  --no-cache          Do not load or save cache
-  --refresh-cache     Force re-fetch IDs for current subset even if cached
+  --cache-file FILE   Path to persistent ID cache (default: ids_cache.ndjson)
+  --no-cache          Do not load or save the ID or availability caches
+  --refresh-cache     Re-check IDs for current subset (conditional GET; unchanged pages are skipped)
+  --http-cache        Also cache shelter detail pages on disk (needs requests-cache)
+  --probe-ttl SECS    Reuse recent availability results for this long (default: 1800, 0 = off)
+  --probe-cache-file FILE
+                      Path to the availability cache (default: probe_cache.sqlite)
 
 Caching explained:
   The script sometimes needs to visit each shelter's detail page to extract the
   real booking PlaceID (used by the availability endpoint). Since this ID rarely
-  changes, we store it in a JSON cache so future runs can skip that step. Use
-  --no-cache to disable caching entirely, or --refresh-cache to re-check the IDs
-  for your current subset. You can relocate the cache file with --cache-file.
+  changes, we append it to a line-delimited JSON cache so future runs can skip
+  that step (the file is compacted when stale lines pile up). Use --no-cache to
+  disable caching entirely, or --refresh-cache to re-check the IDs for your
+  current subset. You can relocate the cache file with --cache-file.
 
 Region presets:
   {preset_list}
@@ -326,10 +785,15 @@ Region presets:
     parser.add_argument("--quiet", action="store_true", help="Suppress per-place booked_hits prints")
     parser.add_argument("--probe", type=int, default=0, help="Print raw BookingDates for first N places and exit")
     parser.add_argument("--out", default="available_shelters.csv", help="CSV output file (default: available_shelters.csv)")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel HTTP workers for ID resolution and availability (default: 8)")
+    parser.add_argument("--qps", type=float, default=10.0, help="Max page/availability requests per second, 0 = unlimited (default: 10)")
     # cache controls
-    parser.add_argument("--cache-file", default="ids_cache.json", help="Path to ID cache file (default: ids_cache.json)")
-    parser.add_argument("--no-cache", action="store_true", help="Do not load or save cache")
+    parser.add_argument("--cache-file", default="ids_cache.ndjson", help="Path to ID cache file (default: ids_cache.ndjson)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not load or save the ID or availability caches")
     parser.add_argument("--refresh-cache", action="store_true", help="Re-resolve IDs even if they exist in cache (for current subset)")
+    parser.add_argument("--http-cache", action="store_true", help=f"Cache shelter detail pages on disk for 30 days ({HTTP_CACHE_FILE})")
+    parser.add_argument("--probe-ttl", type=float, default=1800, help="Reuse cached availability results for this many seconds, 0 = off (default: 1800)")
+    parser.add_argument("--probe-cache-file", default=PROBE_CACHE_FILE, help=f"Path to availability cache (default: {PROBE_CACHE_FILE})")
     return parser
 
 
@@ -363,46 +827,47 @@ def main() -> None:
             requested_regions.append(key)
     requested_regions = sorted(set(requested_regions))
 
-    session = make_session()
+    session = make_session(http_cache=args.http_cache)
+    limiter = RateLimiter(args.qps)
 
-    print("Collecting places from API…")
-    places = fetch_all_places(session)
-    print(f"Fetched {len(places)} places")
+    # Title + region bbox filter (OR across requested regions), applied while paging
+    boxes = [(key, REGION_PRESETS[key]) for key in requested_regions]
 
-    # Title filter
-    if title_sub:
-        before = len(places)
-        places = [p for p in places if title_sub in p["title"].lower()]
-        print(f"Title filter '{args.filter}': {len(places)}/{before} remain.")
+    def keep(p: Dict[str, Any]) -> bool:
+        if title_sub and title_sub not in p["title"].lower():
+            return False
+        if boxes:
+            key = match_region(p, boxes)
+            if key is None:
+                return False
+            if not p["region"]:
+                p["region"] = key  # backfill with preset name
+        return True
 
-    # Region bbox filter (OR across requested regions)
+    # Stop paging once --max-places matches are in hand (limit applies BEFORE resolving IDs)
+    print("Collecting places from API…")
+    places: List[Dict[str, Any]] = []
+    fetched = 0
+    for p in iter_places(session):
+        fetched += 1
+        if keep(p):
+            places.append(p)
+            if len(places) == args.max_places:
+                break
+    print(f"Fetched {fetched} places")
+    filters = [f"title '{args.filter}'"] if title_sub else []
     if requested_regions:
-        before = len(places)
-        kept: List[Dict[str, Any]] = []
-        for p in places:
-            lat, lng = p["lat"], p["lng"]
-            if lat is None or lng is None:
-                continue
-            for key in requested_regions:
-                lat_min, lat_max, lon_min, lon_max = REGION_PRESETS[key]
-                if lat_min <= lat <= lat_max and lon_min <= lng <= lon_max:
-                    if not p["region"]:
-                        p["region"] = key  # backfill with preset name
-                    kept.append(p)
-                    break
-        places = kept
-        print(f"Region filter {requested_regions}: {len(places)}/{before} remain.")
-
-    # Limit for faster test runs (apply BEFORE resolving IDs)
-    if args.max_places > 0:
-        places = places[:args.max_places]
+        filters.append(f"regions {requested_regions}")
+    if filters:
+        print(f"Filter {', '.join(filters)}: {len(places)}/{fetched} remain.")
+    if args.max_places > 0 and len(places) == args.max_places:
         print(f"Limiting to first {len(places)} places for test run.")
 
     # Subset for ID resolution (probe resolves only what's needed)
     subset = places[: args.probe or len(places) ]
 
     # Load cache
-    cache: Dict[str, int] = {}
+    cache: Dict[str, Dict[str, Any]] = {}
     if not args.no_cache:
         cache = load_cache(args.cache_file)
 
@@ -411,10 +876,14 @@ def main() -> None:
     if need_fix or args.refresh_cache:
         to_resolve = subset if args.refresh_cache else need_fix
         print(f"Resolving place IDs… ({len(to_resolve)} to resolve)")
-        fixed = ensure_place_ids(session, to_resolve, cache, refresh_cache=args.refresh_cache)
+        fixed = ensure_place_ids(
+            session, to_resolve, cache,
+            refresh_cache=args.refresh_cache, workers=args.workers, limiter=limiter,
+            cache_path="" if args.no_cache else args.cache_file,
+        )
         print(f"Resolved {fixed} place IDs.")
         if not args.no_cache:
-            save_cache(args.cache_file, cache)
+            compact_cache(args.cache_file)
     else:
         print("All place IDs present and look valid for current subset.")
 
@@ -422,47 +891,71 @@ def main() -> None:
     if args.probe > 0:
         print(f"\nProbe first {min(args.probe, len(subset))} places on {start_dt.date()}:")
         for p in subset[:args.probe]:
-            pid = p.get("place_id") or cache.get(p["url"])
+            pid = p.get("place_id") or cached_place_id(cache, p["url"])
             if not pid or pid in TYPE_IDS:
                 print(f"- {p['title']} (id MISSING)")
                 continue
             bd = fetch_booked_dates(session, pid, start_dt)
-            print(f"- {p['title']} (id {pid}): booked_count={len(bd)}  has {start_dt.date()}? {start_dt.date().isoformat() in bd}")
+            print(f"- {p['title']} (id {pid}): booked_count={len(bd)}  has {start_dt.date()}? {start_dt.date().isoformat() in bd}"
+                  f"  row ids={p['row_ids']}")
         return
 
-    # Availability checks
-    results: List[Dict[str, Any]] = []
-    print(f"\nChecking availability for {len(places)} places on {start_dt.date()} for {nights} night(s)…")
-    for idx, p in enumerate(places, 1):
-        print(f"\n[{idx}/{len(places)}] {p['title']}  {p['url']}")
-        pid = p.get("place_id") or cache.get(p["url"])
-        if not pid or pid in TYPE_IDS:
-            print("  Skipping (missing or invalid place_id)")
-            continue
+    # Availability checks (I/O-bound: fan out over a thread pool sharing one session)
+    type_ids = TYPE_IDS
+    probe_cache: Optional[ProbeCache] = None
+    if args.probe_ttl > 0 and not args.no_cache:
         try:
-            time.sleep(0.25)  # be polite
-            if is_available(session, pid, start_dt, nights, quiet=args.quiet):
-                results.append({
-                    "lat": p["lat"],
-                    "lng": p["lng"],
-                    "region": p["region"],
-                    "name": p["title"],
-                    "url": p["url"],
-                    "place_id": pid,
-                })
-                print("  AVAILABLE ->", p["title"])
-            else:
-                print("  Not available for your range.")
-        except Exception as e:
-            print("  Error:", e)
-
-    # Save CSV (lat,lng first; includes region)
-    with open(args.out, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["lat", "lng", "region", "name", "url", "place_id"])
-        writer.writeheader()
-        writer.writerows(results)
-
-    print(f"\nDone. {len(results)} shelters available for {start_dt.date()} for {nights} nights.")
+            probe_cache = ProbeCache(args.probe_cache_file, args.probe_ttl)
+        except sqlite3.Error as e:
+            print(f"Warning: availability cache unavailable ({e}); checking live.")
+
+    def check_one(idx: int, p: Dict[str, Any]) -> Tuple[List[str], Optional[Dict[str, Any]]]:
+        lines = [f"\n[{idx}/{len(places)}] {p['title']}  {p['url']}"]
+        row: Optional[Dict[str, Any]] = None
+        pid = p.get("place_id") or cached_place_id(cache, p["url"])
+        if not pid or pid in type_ids:
+            lines.append("  Skipping (missing or invalid place_id)")
+        else:
+            try:
+                if is_available(
+                    session, pid, start_dt, nights,
+                    quiet=args.quiet, probe_cache=probe_cache, limiter=limiter, log=lines,
+                ):
+                    row = {
+                        "lat": p["lat"],
+                        "lng": p["lng"],
+                        "region": p["region"],
+                        "name": p["title"],
+                        "url": p["url"],
+                        "place_id": pid,
+                    }
+                    lines.append(f"  AVAILABLE -> {p['title']}")
+                else:
+                    lines.append("  Not available for your range.")
+            except Exception as e:
+                lines.append(f"  Error: {e}")
+        return lines, row
+
+    print(f"\nChecking availability for {len(places)} places on {start_dt.date()} for {nights} night(s)…")
+    # Stream CSV rows as results arrive (lat,lng first; includes region) so a crash keeps what was found.
+    # Only this thread prints and writes; ex.map hands results back in input order.
+    found = 0
+    try:
+        with open(args.out, "w", newline="", encoding="utf-8") as f, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+            writer = csv.DictWriter(f, fieldnames=["lat", "lng", "region", "name", "url", "place_id"])
+            writer.writeheader()
+            for lines, row in ex.map(check_one, range(1, len(places) + 1), places):
+                print("\n".join(lines))
+                if row is not None:
+                    writer.writerow(row)
+                    f.flush()
+                    found += 1
+    finally:
+        if probe_cache is not None:
+            probe_cache.close()
+
+    print(f"\nDone. {found} shelters available for {start_dt.date()} for {nights} nights.")
     print(f"Saved: {args.out}")
 
 